@@ -1,17 +1,30 @@
 import os
 import csv
 import time
+import atexit
+import shelve
+import hashlib
+import orjson
 import logging
 import requests
+import pyarrow as pa
+import pyarrow.parquet as pq
+import threading
 import datetime as dt
 from pathlib import Path
+from functools import wraps
+from operator import attrgetter
+from urllib3.util.retry import Retry
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from dataclasses import dataclass, fields
-from typing import Any, Dict, List, Tuple
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
 
 from config import config_logger
 
 
 CSV_DIR = os.environ.get('CSV_DIR')
+GEOCODE_CACHE = Path(__file__).resolve().parent / 'geocode_cache.db'
 ADDRESSES = [
     'Ядринцевская, 55',
     'Королева, 1б',
@@ -27,6 +40,13 @@ ADDRESSES = [
 
 logger = logging.getLogger(__name__)
 
+_max_connections = 8
+_max_attempts = 4
+_throttle_statuses = (429, 503)
+_semaphore = threading.BoundedSemaphore(_max_connections)
+_file_lock = threading.Lock()
+_cache_lock = threading.Lock()
+_stop = threading.Event()
 _headers = {'user-agent': 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 \
             (KHTML, like Gecko) Chrome/92.0.4515.159 Safari/537.36'}
 _city_id = '89026,89030,89027,2355612,89946,89966,89958,89978,89963,89996,\
@@ -52,10 +72,10 @@ _search_params = {
     'fields': 'id,name_ru,name_seo,name_socr,type,abbr_raw_ru,street,params,city,area,region,location,line,params.id',
     'region_id': 1054,
 }
+_search_params_items = tuple(_search_params.items())
 _offers_params = {
 
     'limit': 25,
-    'offset': 0,
     'sort': '-billing_weight,-order_date,-creation_date',
     'query[0][deal_type]': 'sell',
     'query[0][rubric]': 'flats',
@@ -63,6 +83,15 @@ _offers_params = {
     'filter[region_id]': 1054,
     'status': 'published',
 }
+_offers_params_items = tuple(_offers_params.items())
+_session = requests.Session()
+_session.headers.update(_headers)
+_session.mount('https://', HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=20,
+    # throttling statuses are retried in get_json to slow down rate limiter
+    max_retries=Retry(total=3, backoff_factor=0.5, status_forcelist=[500, 502, 504]),
+))
 
 
 @dataclass
@@ -86,6 +115,22 @@ class Offer:
         return [x.name for x in fields(Offer)]
 
 
+_offer_getter = attrgetter(*Offer.fields())
+_offer_schema = pa.schema([
+    ('offer_id', pa.int64()),
+    ('date', pa.date32()),
+    ('url', pa.string()),
+    ('address', pa.string()),
+    ('area', pa.int64()),
+    ('floor', pa.int32()),
+    ('release_date', pa.int32()),
+    ('price', pa.int64()),
+    ('house_material', pa.string()),
+    ('lat', pa.float64()),
+    ('lon', pa.float64()),
+])
+
+
 class ParserException(Exception):
     pass
 
@@ -94,6 +139,156 @@ class NotFoundException(ParserException):
     pass
 
 
+class TokenBucket:
+    """Thread safe token bucket rate limiter,
+    rate grows additively on success and halves on throttling
+    """
+
+    def __init__(self, rate: float, burst: int, min_rate: float = 0.5) -> None:
+        """
+        Args:
+            rate (float): Max requests per second
+            burst (int): Max tokens in bucket
+            min_rate (float, optional): Min requests per second. Defaults to 0.5.
+        """
+
+        self.max_rate = rate
+        self.min_rate = min_rate
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, stop: Optional[threading.Event] = None) -> bool:
+        """Wait until token is available and take it
+
+        Args:
+            stop (Optional[threading.Event], optional): Event to stop waiting. Defaults to None.
+
+        Returns:
+            bool: True if token is taken, False if waiting is stopped
+        """
+
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return True
+                delay = (1 - self._tokens) / self.rate
+
+            if stop is None:
+                time.sleep(delay)
+            elif stop.wait(delay):
+                return False
+
+    def increase(self) -> None:
+        """Increase rate by one request per second up to max rate"""
+
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + 1)
+
+    def decrease(self) -> None:
+        """Halve rate down to min rate"""
+
+        with self._lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+
+
+_rate_limiter = TokenBucket(rate=8, burst=4)
+
+
+def retry_after(r: requests.Response, attempt: int) -> float:
+    """Get delay before retry of throttled request
+
+    Args:
+        r (requests.Response): Throttled response
+        attempt (int): Zero based attempt number
+
+    Returns:
+        float: Seconds from Retry-After header or exponential backoff
+    """
+
+    value = r.headers.get('Retry-After', '')
+    if value.isdigit():
+        return float(value)
+    return 0.5 * 2 ** attempt
+
+
+def get_json(url: str, params: Tuple[Tuple[str, Any], ...]) -> Dict[str, Any]:
+    """Make GET request with limited concurrency and rate
+
+    Args:
+        url (str): Request url
+        params (Tuple[Tuple[str, Any], ...]): Query params
+
+    Raises:
+        requests.HTTPError: If request is still throttled after all attempts
+        ParserException: If parsing is stopped
+
+    Returns:
+        Dict[str, Any]: Response json
+    """
+
+    for attempt in range(_max_attempts):
+        if _stop.is_set() or not _rate_limiter.acquire(_stop):
+            raise ParserException('Parsing stopped.')
+
+        with _semaphore:
+            try:
+                r = _session.get(url, params=params)
+            except requests.exceptions.RetryError:
+                _rate_limiter.decrease()
+                raise
+
+        if r.status_code not in _throttle_statuses:
+            _rate_limiter.increase()
+            return orjson.loads(r.content)
+
+        _rate_limiter.decrease()
+        if attempt + 1 < _max_attempts:
+            _stop.wait(retry_after(r, attempt))
+
+    r.raise_for_status()
+
+
+def geocode_cache(func: Callable[[str], Tuple[int, str]]) -> Callable[[str], Tuple[int, str]]:
+    """Cache address search results on disk by query
+
+    Args:
+        func (Callable[[str], Tuple[int, str]]): Search function
+
+    Returns:
+        Callable[[str], Tuple[int, str]]: Cached search function
+    """
+
+    cache = None
+
+    @wraps(func)
+    def wrapper(query: str) -> Tuple[int, str]:
+        nonlocal cache
+        key = hashlib.blake2b(query.encode()).hexdigest()
+
+        with _cache_lock:
+            if cache is None:
+                cache = shelve.open(str(GEOCODE_CACHE))
+                atexit.register(cache.close)
+            if key in cache:
+                return cache[key]
+
+        result = func(query)
+        with _cache_lock:
+            cache[key] = result
+        return result
+
+    return wrapper
+
+
+@geocode_cache
 def search_address(query: str) -> Tuple[int, str]:
     """Search address by query
 
@@ -105,22 +300,17 @@ def search_address(query: str) -> Tuple[int, str]:
     """
 
     url = 'https://api.n1.ru/api/v1/geo/geocoder/with_cities/'
-    params = _search_params.copy()
-    params['q'] = query
+    params = (*_search_params_items, ('q', query))
 
     try:
-        r = requests.get(url, params=params, headers=_headers)
-        response =  r.json()
+        response = get_json(url, params)
 
         if not 'result' in response or not response['result']:
             raise NotFoundException('Result not found or empty.')
         
-        address = None
-        house_number = query.split(',')[-1].strip()
-        for x in response['result']:
-            if x['name_ru'].lower() == house_number:
-                address = x
-                break
+        house_number = query.split(',')[-1].strip().lower()
+        addresses = {x['name_ru'].lower(): x for x in reversed(response['result'])}  # first match wins
+        address = addresses.get(house_number)
         
         if address is None:
             raise NotFoundException(f'Not found house number {house_number} in result: {response["result"]}')
@@ -147,27 +337,32 @@ def get_offers(street_id: int, house_number: str) -> List[Dict[str, Any]]:
     """
 
     url = 'https://api.n1.ru/api/v1/offers/'
-    params = _offers_params.copy()
-    params['filter_or[addresses][0][street_id]'] = street_id
-    params['filter_or[addresses][0][house_number]'] = house_number
-    offset, count, offers = 0, 1, []
-
-    while offset < count: # while do
+    params = (
+        *_offers_params_items,
+        ('filter_or[addresses][0][street_id]', street_id),
+        ('filter_or[addresses][0][house_number]', house_number),
+    )
+    limit = _offers_params['limit']
+
+    def get_page(offset: int) -> Dict[str, Any]:
         try:
-            r = requests.get(url, params=params, headers=_headers)
-            response = r.json()
-            count = response['metadata']['resultset']['count']
+            return get_json(url, (*params, ('offset', offset)))
         except requests.RequestException as e:
             raise ParserException(
                 f'Fail make request. street_id: {street_id}, house_number: {house_number}'
             ) from e
-        except KeyError as e:
-            raise ParserException('It was not possible to get the number of offers') from e
-        
-        offers.extend(response.get('result', []))
-        offset += 25
-        time.sleep(0.5)
-    
+
+    response = get_page(0)
+    try:
+        count = response['metadata']['resultset']['count']
+    except KeyError as e:
+        raise ParserException('It was not possible to get the number of offers') from e
+
+    offers = response.get('result', [])
+    with ThreadPoolExecutor(max_workers=_max_connections) as executor:
+        for response in executor.map(get_page, range(limit, count, limit)):
+            offers.extend(response.get('result', []))
+
     return offers
 
 
@@ -205,11 +400,36 @@ def parse_raw_offer(raw_offer: Dict[str, Any]) -> Offer:
         raise ParserException(f'Fail parse raw offer. value: {raw_offer}') from e
 
 
-def save_offers(offers: List[Offer]) -> Path:
-    """Save offer list to file
+def unique_offers(raw_offers: Iterable[Dict[str, Any]]) -> Iterator[Offer]:
+    """Parse raw offers lazily skipping duplicates and invalid offers
 
     Args:
-        offers (List[Offer]): Offers list
+        raw_offers (Iterable[Dict[str, Any]]): Raw offers
+
+    Yields:
+        Offer: Unique offer object
+    """
+
+    seen = set()
+    for raw_offer in raw_offers:
+        try:
+            offer = parse_raw_offer(raw_offer)
+        except ParserException as e:
+            logger.exception(e)
+            continue
+
+        if offer.offer_id in seen:
+            continue
+
+        seen.add(offer.offer_id)
+        yield offer
+
+
+def save_offers(offers: Iterable[Offer]) -> Path:
+    """Save offers to file
+
+    Args:
+        offers (Iterable[Offer]): Offers
     
     Returns:
         Path: File path
@@ -217,32 +437,72 @@ def save_offers(offers: List[Offer]) -> Path:
 
     directory = Path(__file__).resolve().parent / CSV_DIR
 
-    if not directory.exists():
-        try:
-            os.mkdir(str(directory))
-        except OSError  as e:
-            raise ParserException(f'Fail create dicrectory. value: {directory}') from e
+    try:
+        directory.mkdir(parents=True, exist_ok=True)
+    except OSError  as e:
+        raise ParserException(f'Fail create dicrectory. value: {directory}') from e
     
     path = directory / f'{dt.date.today()}.csv'
-    write_header = not path.exists()
     try:
-        with open(path, 'a') as f:
-            writer = csv.DictWriter(f, fieldnames=Offer.fields(), delimiter=';')
+        try:
+            f = open(path, 'x', newline='')
+            write_header = True
+        except FileExistsError:
+            f = open(path, 'a', newline='')
+            write_header = False
+
+        with f:
+            writer = csv.writer(f, delimiter=';')
             
             if write_header:
-                writer.writeheader()
-            writer.writerows(map(vars, offers))
+                writer.writerow(Offer.fields())
+            writer.writerows(map(_offer_getter, offers))
         
         return path
     except OSError  as e:
         raise ParserException(f'Fail write to file. path: {path}') from e
 
 
-def parse_by_raw_address(address: str) -> None:
+def save_offers_parquet(offers: List[Offer]) -> Path:
+    """Save offers to daily parquet file merging them with already saved ones
+
+    Args:
+        offers (List[Offer]): Offers
+
+    Returns:
+        Path: File path
+    """
+
+    path = Path(__file__).resolve().parent / CSV_DIR / f'{dt.date.today()}.parquet'
+    tmp_path = path.with_suffix('.parquet.tmp')
+    try:
+        tables = []
+        if path.exists():
+            # parquet can't be appended, so the file is rewritten
+            tables.append(pq.read_table(path, schema=_offer_schema))
+            saved_ids = set(tables[0].column('offer_id').to_pylist())
+            offers = [x for x in offers if x.offer_id not in saved_ids]
+
+        tables.append(pa.Table.from_pydict(
+            {x: [getattr(offer, x) for offer in offers] for x in Offer.fields()},
+            schema=_offer_schema,
+        ))
+        pq.write_table(pa.concat_tables(tables), tmp_path, compression='zstd')
+        os.replace(tmp_path, path)
+
+        return path
+    except (OSError, pa.ArrowException) as e:
+        raise ParserException(f'Fail write to file. path: {path}') from e
+
+
+def parse_by_raw_address(address: str) -> List[Offer]:
     """Parse offers pipeline
 
     Args:
         address (str): Raw addres
+
+    Returns:
+        List[Offer]: Saved offers
     """
 
     logger.info(f'Search address: {address}')
@@ -252,32 +512,47 @@ def parse_by_raw_address(address: str) -> None:
     raw_offers = get_offers(street_id, house_number)
     logger.debug(f'Raw offers cound {len(raw_offers)}')
 
-    offers = [parse_raw_offer(x) for x in raw_offers]
-    if offers:
-        logger.debug(f'Parsed offers count {len(raw_offers)}')
-    else:
+    offers = list(unique_offers(raw_offers))
+    if not offers:
         logger.warning('Offers not found.')
-        return
+        return offers
 
-    offers = {offer.offer_id: offer for offer in offers} # unique offers
-    path = save_offers(list(offers.values()))
+    with _file_lock:
+        path = save_offers(offers)
     logger.info(f'Writed to {path}')
 
+    return offers
+
 
 def main():
     config_logger(logger)
     logger.info('Start parsing...')
 
-    for address in ADDRESSES:
+    offers = []
+    with ThreadPoolExecutor(max_workers=len(ADDRESSES)) as executor:
+        futures = [executor.submit(parse_by_raw_address, x) for x in ADDRESSES]
         try:
-            parse_by_raw_address(address)
+            for future in as_completed(futures):
+                try:
+                    offers.extend(future.result())
+                except ParserException as e:
+                    logger.exception(e)
+                    continue
+                except:
+                    logger.exception('Something went wrong.')
         except KeyboardInterrupt:
-            break
+            # running addresses stop on their next request
+            _stop.set()
+            executor.shutdown(wait=False, cancel_futures=True)
+            logger.warning('Parsing interrupted.')
+
+    # parquet copy of the day is written once, it has the same offers as csv one
+    if offers:
+        try:
+            path = save_offers_parquet(offers)
+            logger.info(f'Writed to {path}')
         except ParserException as e:
             logger.exception(e)
-            continue
-        except:
-            logger.exception('Something went wrong.')
 
 
 if __name__ == '__main__':
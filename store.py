@@ -1,22 +1,32 @@
 from __future__ import annotations
 
+import io
 import os
 import csv
 import logging
 import datetime as dt
 from pathlib import Path
-from decimal import Decimal
-from itertools import groupby
-from typing import Any, Dict, List, Union
-
+from concurrent.futures import ProcessPoolExecutor
+from collections import deque
+from decimal import Context as DecimalContext
+from itertools import chain, islice
+from dataclasses import dataclass, fields
+from typing import Any, Dict, List, Optional, Set, Union
+
+import numpy as np
+import pandas as pd
 from peewee import * 
 from peewee import PeeweeException
+import psycopg2
+from psycopg2.extras import execute_values
 
 from config import config_logger
 
 
 CSV_DIR = os.environ.get('CSV_DIR')
-FILES = (Path(__file__).resolve().parent / CSV_DIR).glob('*.csv')
+_files_dir = Path(__file__).resolve().parent / CSV_DIR
+# parquet file is preferred over csv one of the same date
+FILES = {x.stem: x for x in chain(_files_dir.glob('*.csv'), _files_dir.glob('*.parquet'))}.values()
 
 db = PostgresqlDatabase(
     os.environ.get('POSTGRES_DB'),
@@ -25,23 +35,135 @@ db = PostgresqlDatabase(
 )
 logger = logging.getLogger(__name__)
 
+_to_decimal = DecimalContext(prec=17).create_decimal
+
 
 class StoreException(Exception):
     pass
 
 
+@dataclass
+class OfferBatch:
+    """Offers stored by columns"""
+
+    offer_id: np.ndarray
+    date: np.ndarray
+    url: np.ndarray
+    address: np.ndarray
+    area: np.ndarray
+    floor: np.ndarray
+    release_date: np.ndarray
+    price: np.ndarray
+    house_material: np.ndarray
+    lat: np.ndarray
+    lon: np.ndarray
+
+    def __post_init__(self):
+        # day precision makes .tolist() return dt.date values
+        self.date = self.date.astype('datetime64[D]')
+
+    def __len__(self) -> int:
+        return len(self.offer_id)
+
+    @classmethod
+    def from_frame(cls, df: pd.DataFrame) -> OfferBatch:
+        """Make batch from data frame columns
+
+        Args:
+            df (pd.DataFrame): Offers data frame
+
+        Returns:
+            OfferBatch: Offers batch
+        """
+
+        return cls(**{x.name: df[x.name].to_numpy() for x in fields(cls)})
+
+    def rows(self, fields: List[str], mask: Optional[np.ndarray] = None) -> List[List[Any]]:
+        """Get rows of python values by fields for masked offers
+
+        Args:
+            fields (List[str]): Batch fields
+            mask (Optional[np.ndarray], optional): Boolean mask of offers. Defaults to all offers.
+
+        Returns:
+            List[List[Any]]: Rows
+        """
+
+        if mask is None:
+            mask = slice(None)
+
+        columns = [getattr(self, field)[mask].tolist() for field in fields]
+        return [list(row) for row in zip(*columns)]
+
+
 class BaseModel(Model):
     @classmethod
-    def insert_butch(cls, fields: List[str], rows: List[List[Any]]) -> None:
+    def insert_butch(
+        cls,
+        fields: List[str],
+        rows: List[List[Any]],
+        conflict_fields: Optional[List[str]] = None,
+    ) -> None:
         """Model batch insert values by fields
 
+        Args:
+            fields (List[str]): Model fields
+            rows (List[List[Any]]): List values
+            conflict_fields (Optional[List[str]], optional): Unique model fields,
+                rows conflicting on them are skipped. Defaults to None.
+        """
+
+        sql = f'INSERT INTO {cls._meta.table_name} ({cls.columns(fields)}) VALUES %s'
+        if conflict_fields:
+            sql += f' ON CONFLICT ({cls.columns(conflict_fields)}) DO NOTHING'
+
+        cursor = cls._meta.database.cursor()
+        try:
+            execute_values(cursor, sql, cls.db_rows(fields, rows), page_size=1000)
+        except psycopg2.Error as e:
+            raise StoreException(f'Fail insert rows to {cls._meta.table_name}.') from e
+
+    @classmethod
+    def copy_from(cls, fields: List[str], rows: List[List[Any]]) -> None:
+        """Model bulk load values by fields with COPY
+
         Args:
             fields (List[str]): Model fields
             rows (List[List[Any]]): List values
         """
 
-        for butch in chunked(rows, 100):
-            cls.insert_many(butch, fields).execute()
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerows(
+            [r'\N' if value is None else value for value in row]
+            for row in cls.db_rows(fields, rows)
+        )
+        buffer.seek(0)
+
+        cursor = cls._meta.database.cursor()
+        try:
+            cursor.copy_expert(
+                f"COPY {cls._meta.table_name} ({cls.columns(fields)}) FROM STDIN WITH (FORMAT csv, NULL '\\N')",
+                buffer,
+            )
+        except psycopg2.Error as e:
+            raise StoreException(f'Fail copy rows to {cls._meta.table_name}.') from e
+
+    @classmethod
+    def db_rows(cls, fields: List[str], rows: List[List[Any]]) -> List[List[Any]]:
+        """Convert values to database values by model fields,
+        e.g. floats for IntegerField are cast to int
+
+        Args:
+            fields (List[str]): Model fields
+            rows (List[List[Any]]): List values
+
+        Returns:
+            List[List[Any]]: List database values
+        """
+
+        db_values = [cls._meta.fields[field].db_value for field in fields]
+        return [[db_value(value) for db_value, value in zip(db_values, row)] for row in rows]
 
     @classmethod
     def fields(cls) -> List[str]:
@@ -53,6 +175,19 @@ class BaseModel(Model):
 
         return list(cls._meta.fields.keys())[1:]
 
+    @classmethod
+    def columns(cls, fields: List[str]) -> str:
+        """Get comma separated table columns by model fields
+
+        Args:
+            fields (List[str]): Model fields
+
+        Returns:
+            str: Table columns
+        """
+
+        return ', '.join(cls._meta.fields[field].column_name for field in fields)
+
     class Meta:
         database = db
 
@@ -93,31 +228,41 @@ class AvgPriceModel(BaseModel):
     avg_price_change = IntegerField(null=True)
 
     @staticmethod
-    def last_avg_price(address: str, end_date: dt.date) -> Union[AvgPriceModel, None]:
-        """Return last average price by date for address
+    def last_avg_prices(addresses: List[str], end_date: dt.date) -> Dict[str, AvgPriceModel]:
+        """Return last average prices by date for addresses in a single query
 
         Args:
-            address (str): Address
+            addresses (List[str]): Addresses
             end_date (dt.date): End date
 
         Returns:
-            Union[AvgPriceModel, None]: Last average price or None if not found.
+            Dict[str, AvgPriceModel]: Last average price by address,
+                addresses without average prices are omitted.
         """
 
-        try:
-            return (
-                AvgPriceModel.select()
+        last_dates = (
+            AvgPriceModel
+                .select(AvgPriceModel.address, fn.MAX(AvgPriceModel.date).alias('last_date'))
                 .where(
-                    AvgPriceModel.address == address,
+                    AvgPriceModel.address.in_(addresses),
                     AvgPriceModel.date < end_date,
                 )
-                .order_by(AvgPriceModel.date)[-1]
+                .group_by(AvgPriceModel.address)
+                .alias('last_dates')
+        )
+
+        try:
+            avg_prices = (
+                AvgPriceModel.select()
+                .join(last_dates, on=(
+                    (AvgPriceModel.address == last_dates.c.address)
+                    & (AvgPriceModel.date == last_dates.c.last_date)
+                ))
             )
-        except IndexError:
-            return None
+            return {avg_price.address: avg_price for avg_price in avg_prices}
         except PeeweeException as e:
             raise StoreException(
-                f'Fail get average prices for daress: {address}, date: {end_date}.'
+                f'Fail get average prices for addresses: {addresses}, date: {end_date}.'
             ) from e
 
     class Meta:
@@ -141,148 +286,131 @@ def get_exists_dates(cls: Union[PriceModel, AvgPriceModel]) -> List[dt.date]:
             raise StoreException('Error get price dates from db.') from e
 
 
-def parse_raw_offer(raw_offer: Dict[str, Any]) -> Dict[str, Any]:
-    """Cast string values to valid Offer fields
-
-    Args:
-        raw_offer (Dict[str, Any]): Raw value
-
-    Returns:
-        Dict[str, Any]: Offer as dict
-    """
-
-    try:
-        raw_offer['offer_id'] = int(raw_offer['offer_id'])
-        raw_offer['date'] = dt.datetime.strptime(raw_offer['date'], '%Y-%m-%d')
-        raw_offer['area'] = int(int(raw_offer['area']) / 100)
-        raw_offer['floor'] = int(raw_offer['floor'])
-        raw_offer['release_date'] = int(raw_offer['release_date'])
-        raw_offer['price'] = int(raw_offer['price'])
-        raw_offer['lat'] = Decimal(raw_offer['lat'])
-        raw_offer['lon'] = Decimal(raw_offer['lon'])
-    except Exception as e:
-        raise StoreException(f'Fail parse raw offer. value: {raw_offer}') from e
-
-    return raw_offer
-
-
-def read_offers(file_path: Path) -> List[Dict[str, Any]]:
-    """Read offers from csv file
+def read_offers(file_path: Path) -> OfferBatch:
+    """Read offers from csv or parquet file
 
     Args:
         file_path (Path): File path
 
     Returns:
-        List[Dict[str, Any]]: List Offers as dict
+        OfferBatch: Offers batch
     """
 
     try:
-        with open(str(file_path)) as f:
-            reader = csv.DictReader(f, delimiter=';')
-            return [parse_raw_offer(x) for x in reader]
+        if file_path.suffix == '.parquet':
+            df = pd.read_parquet(file_path)
+            df['date'] = pd.to_datetime(df['date'])
+            # same decimal conversion as for csv values
+            df['lat'] = df['lat'].map(repr)
+            df['lon'] = df['lon'].map(repr)
+        else:
+            df = pd.read_csv(
+                file_path,
+                sep=';',
+                dtype={
+                    'offer_id': 'int64',
+                    'floor': 'int32',
+                    'release_date': 'int32',
+                    'price': 'int64',
+                    'lat': str,
+                    'lon': str,
+                },
+                parse_dates=['date'],
+                keep_default_na=False,  # keep strings like '' or 'NA' as is
+            )
     except OSError as e:
         raise StoreException(f'Fail read file {file_path}.') from e
+    except ValueError as e:
+        raise StoreException(f'Fail parse offers from file {file_path}.') from e
+
+    try:
+        df['area'] = df['area'].astype('int64') // 100
+        df['lat'] = df['lat'].map(_to_decimal)
+        df['lon'] = df['lon'].map(_to_decimal)
+        return OfferBatch.from_frame(df)
+    except Exception as e:
+        raise StoreException(f'Fail parse offers from file {file_path}.') from e
 
 
-def get_offers_rows(offers: List[Dict[str, Any]]) -> List[Any]:
-    """Get new address rows
+def get_offers_rows(offers: OfferBatch) -> List[Any]:
+    """Get address rows
 
     Args:
-        offers (List[Dict[str, Any]]): Offers list
+        offers (OfferBatch): Offers batch
 
     Returns:
         List[Any]: Address rows
     """
-    
-    offer_id = [offer['offer_id'] for offer in offers]
-
-    try:
-        exists_addresses = (
-            OfferModel
-                .select(OfferModel.offer_id)
-                .where(OfferModel.offer_id.in_(offer_id))
-        )
-    except PeeweeException as e:
-        raise StoreException('Error get addresses id from db.') from e
 
-    rows = []
     fields = 'offer_id url address area floor release_date house_material lat lon'.split()
-    exists_id = {address.offer_id for address in exists_addresses}
-
-    for offer in offers:
-        if offer['offer_id'] in exists_id:
-            continue
-
-        rows.append([offer.get(field) for field in fields])
-
-    return rows
+    return offers.rows(fields)
 
 
-def get_price_rows(offers: List[Dict[str, Any]]) -> List[Any]:
+def get_price_rows(offers: OfferBatch, exists_dates: Set[dt.date]) -> List[Any]:
     """Get new price rows
 
     Args:
-        offers (List[Dict[str, Any]]): Offers list
+        offers (OfferBatch): Offers batch
+        exists_dates (Set[dt.date]): Dates already stored in db
 
     Returns:
         List[Any]: Price rows
     """
 
-    rows = []
-    exists_dates = set(get_exists_dates(PriceModel))
-    for offer in offers:
-        if offer['date'] in exists_dates:
-            continue
-
-        rows.append([offer['offer_id'], offer['date'], offer['price']])
-
-    return rows
+    exists_dates = np.array(list(exists_dates), dtype='datetime64[D]')
+    return offers.rows(['offer_id', 'date', 'price'], ~np.isin(offers.date, exists_dates))
 
 
-def get_avg_prices_rows(offers: List[Dict[str, Any]]) -> List[Any]:
+def get_avg_prices_rows(offers: OfferBatch) -> List[Any]:
     """Get new average price rows
 
     Args:
-        offers (List[Dict[str, Any]]): Offers list
+        offers (OfferBatch): Offers batch
 
     Returns:
         List[Any]: Average price rows
     """
-    avg_prices = []
-    grouper = lambda x: x['address']
-    for address, items in groupby(sorted(offers, key=grouper), key=grouper):
-        items = list(items)
-        date = items[0]['date']
 
-        # avg price sq.m
-        avg_price = sum([item['price'] / item['area'] for item in items]) / len(items)
-        avg_price = round(avg_price, 2)
+    if not offers:
+        return []
+
+    addresses, inverse = np.unique(offers.address, return_inverse=True)
+    date = offers.date[0].tolist()
+    last_avg_prices = AvgPriceModel.last_avg_prices(addresses.tolist(), date)
+
+    # avg price sq.m
+    sums = np.bincount(inverse, weights=offers.price / offers.area)
+    avg_prices = np.round(sums / np.bincount(inverse), 2)
 
+    rows = []
+    for address, avg_price in zip(addresses.tolist(), avg_prices.tolist()):
         # avg change
         avg_price_change = None
-        if last_avg_price := AvgPriceModel.last_avg_price(address, date):
+        if last_avg_price := last_avg_prices.get(address):
             avg_price_change = avg_price - last_avg_price.avg_price
-        
-        avg_prices.append([address, date, avg_price, avg_price_change])
 
-    return avg_prices
+        rows.append([address, date, avg_price, avg_price_change])
+
+    return rows
 
 
-def save_file(file_path: Path) -> None:
-    """Save file to db
+def save_file(file_path: Path, offers: OfferBatch, exists_dates: Set[dt.date]) -> None:
+    """Save offers read from file to db
 
     Args:
         file_path (Path): File path
+        offers (OfferBatch): Offers batch read from file
+        exists_dates (Set[dt.date]): Price dates already stored in db,
+            updated with saved dates
     """
 
-    logger.info(f'Read file: {file_path}')
-    offers = read_offers(file_path)
+    logger.info(f'Save file: {file_path}')
     logger.debug(f'Found {len(offers)} offers.')
     
     offer_rows = get_offers_rows(offers)
-    logger.debug(f'Offers for storing count: {len(offer_rows)}')
+    logger.debug(f'Offers for inserting count: {len(offer_rows)}, existing are skipped by db.')
 
-    price_rows = get_price_rows(offers)
+    price_rows = get_price_rows(offers, exists_dates)
     logger.debug(f'Prices for storing count: {len(price_rows)}')
 
     avg_price_rows = get_avg_prices_rows(offers)
@@ -291,9 +419,13 @@ def save_file(file_path: Path) -> None:
     # save data
     try:
         with db.atomic():
-            OfferModel.insert_butch(OfferModel.fields(), offer_rows)
-            PriceModel.insert_butch(PriceModel.fields(), price_rows)
-            AvgPriceModel.insert_butch(AvgPriceModel.fields(), avg_price_rows)
+            # file can be loaded again, so durability of commit is not needed
+            db.execute_sql('SET LOCAL synchronous_commit = off')
+            # existing offers are skipped by unique offer_id
+            OfferModel.insert_butch(OfferModel.fields(), offer_rows, conflict_fields=['offer_id'])
+            PriceModel.copy_from(PriceModel.fields(), price_rows)
+            AvgPriceModel.copy_from(AvgPriceModel.fields(), avg_price_rows)
+        exists_dates.update(row[1] for row in price_rows)
         logger.info(f'Success saved file: {file_path}')
     except PeeweeException as e:
         raise StoreException('Error db on save data.') from e
@@ -311,22 +443,37 @@ def db_connect() -> None:
 
 def main():
     config_logger(logger)
-    
-    db_connect()
-    logger.info('Start saving files...')
 
     to_date = lambda x: dt.datetime.strptime(x.stem, '%Y-%m-%d')
-    for file_path in sorted(FILES, key=to_date):
-        try:
-            save_file(file_path)
-        except KeyboardInterrupt:
-            break
-        except StoreException as e:
-            logger.exception(e)
-            continue
-        except:
-            logger.exception('Something went wrong.')
-
+    file_paths = iter(sorted(FILES, key=to_date))
+    max_workers = os.cpu_count()
+
+    # files are parsed in worker processes, db writes stay in main process
+    # in date order. Workers start before db connection to not share it.
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        submit = lambda x: (x, executor.submit(read_offers, x))
+        pending = deque(map(submit, islice(file_paths, max_workers)))
+
+        db_connect()
+        exists_dates = set(get_exists_dates(PriceModel))
+        logger.info('Start saving files...')
+
+        # keep only few read files in memory
+        while pending:
+            file_path, future = pending.popleft()
+            pending.extend(map(submit, islice(file_paths, 1)))
+
+            try:
+                save_file(file_path, future.result(), exists_dates)
+            except KeyboardInterrupt:
+                executor.shutdown(wait=False, cancel_futures=True)
+                logger.warning('Saving interrupted.')
+                break
+            except StoreException as e:
+                logger.exception(e)
+                continue
+            except:
+                logger.exception('Something went wrong.')
 
 if __name__ == '__main__':
     main()